@@ -6,6 +6,20 @@ with open("README.md", "r") as fh:
 # See https://packaging.python.org/guides/single-sourcing-package-version/
 exec(open("tbcontrol/version.py").read())
 
+# The compiled simulation kernel is optional: without Cython or a working C
+# compiler blocksim falls back to numba or plain Python
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    ext_modules = []
+else:
+    ext_modules = cythonize(
+        [setuptools.Extension("tbcontrol._blocksim_core", ["tbcontrol/_blocksim_core.pyx"])]
+    )
+    # cythonize does not pass on the optional flag
+    for extension in ext_modules:
+        extension.optional = True
+
 setuptools.setup(
     name="tbcontrol",
     version=__version__,
@@ -16,6 +30,8 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/alchemyst/Dynamics-and-Control",
     packages=setuptools.find_packages(),
+    package_data={"tbcontrol": ["*.pyx"]},
+    ext_modules=ext_modules,
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: GNU General Public License v3 (GPLv3)",
@@ -0,0 +1,52 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, initializedcheck=False
+"""Ahead of time compiled simulation kernel for blocksim
+
+This is the same kernel as blocksim._simulate, for installations without
+numba. It is built by setup.py when Cython is available.
+"""
+from cython cimport floating
+import numpy
+
+
+def simulate(const floating[:, :, ::1] As, const floating[:, ::1] Bs,
+             const floating[:, ::1] Cs, const floating[::1] Ds,
+             const long long[::1] states, const long long[::1] offsets,
+             const long long[::1] block_inputs, const long long[::1] block_outputs,
+             const floating[:, ::1] S, const long long[::1] sum_outputs,
+             const long long[::1] input_signals, const floating[:, ::1] input_values,
+             floating[::1] xs, floating[:, ::1] ys, Py_ssize_t n_steps):
+    """Integrate a compiled diagram over n_steps, see blocksim._simulate"""
+    cdef Py_ssize_t n_blocks = As.shape[0]
+    cdef Py_ssize_t n_signals = ys.shape[0]
+    cdef Py_ssize_t i, j, k, l, m, n, o
+    cdef floating u, x, y, total
+    dtype = numpy.float32 if floating is float else numpy.float64
+    cdef floating[::1] signals = numpy.zeros(n_signals, dtype=dtype)
+    cdef floating[::1] xnew = numpy.zeros(As.shape[1], dtype=dtype)
+
+    with nogil:
+        for k in range(n_steps):
+            for j in range(input_signals.shape[0]):
+                signals[input_signals[j]] = input_values[j, k]
+            for j in range(S.shape[0]):
+                total = S[j, 0]*signals[0]
+                for m in range(1, n_signals):
+                    total = total + S[j, m]*signals[m]
+                signals[sum_outputs[j]] = total
+            for i in range(n_blocks):
+                n = states[i]
+                o = offsets[i]
+                u = signals[block_inputs[i]]
+                y = Ds[i]*u
+                for m in range(n):
+                    y = y + Cs[i, m]*xs[o + m]
+                signals[block_outputs[i]] = y
+                for m in range(n):
+                    x = Bs[i, m]*u
+                    for l in range(n):
+                        x = x + As[i, m, l]*xs[o + l]
+                    xnew[m] = x
+                for m in range(n):
+                    xs[o + m] = xnew[m]
+            for m in range(n_signals):
+                ys[m, k] = signals[m]
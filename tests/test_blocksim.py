@@ -0,0 +1,317 @@
+import os
+import subprocess
+import sys
+from tbcontrol import blocksim
+import numpy
+import pytest
+
+
+def stepped(diagram, ts):
+    """Simulate by stepping through the diagram block by block"""
+    dt = ts[1]
+    diagram.reset()
+    outputs = {}
+    for t in ts:
+        for signal, value in diagram.step(t, dt).items():
+            outputs.setdefault(signal, []).append(value)
+    return outputs
+
+
+def control_diagram():
+    Gc = blocksim.PI('Gc', 'e', 'u', 0.5, 5)
+    G = blocksim.LTI('G', 'u', 'yu', 2, [10, 7, 1])
+    Gd = blocksim.LTI('Gd', 'd', 'yd', 1, [3, 1])
+    return blocksim.simple_control_diagram(Gc, G, Gd,
+                                           ysp=blocksim.step(starttime=1),
+                                           d=blocksim.step(starttime=20))
+
+
+def test_compiled_matches_stepped():
+    ts = numpy.linspace(0, 50, 1001)
+    diagram = control_diagram()
+    assert diagram.compile(ts[1]) is not None
+
+    expected = stepped(diagram, ts)
+    outputs = diagram.simulate(ts)
+
+    assert set(outputs) == set(expected)
+    for signal, values in expected.items():
+        assert outputs[signal] == pytest.approx(values)
+    assert outputs['y'][-1] == pytest.approx(1, abs=1e-2)
+
+
+def test_compile_falls_back_for_delay():
+    Gc = blocksim.PI('Gc', 'e', 'u', 0.1, 50)
+    G = blocksim.LTI('G', 'u', 'yu', 10, [100, 1], 10)
+    diagram = blocksim.simple_control_diagram(Gc, G)
+    assert diagram.compile(0.1) is None
+
+    ts = numpy.linspace(0, 100, 501)
+    outputs = diagram.simulate(ts)
+    expected = stepped(diagram, ts)
+    assert outputs['y'] == pytest.approx(expected['y'])
+
+
+@pytest.mark.parametrize("ts", [numpy.linspace(0, 10, 1001),
+                                numpy.sort(numpy.random.default_rng(0).uniform(0, 10, 500))],
+                         ids=['uniform', 'nonuniform'])
+@pytest.mark.parametrize("delay", [0.001, 2.345, 20])
+def test_deadtime_matches_interp(ts, delay):
+    us = numpy.sin(ts) + ts
+    deadtime = blocksim.Deadtime('D', 'u', 'y', delay)
+    history_ts, history_us = [0], [0]
+    for t, u in zip(ts, us):
+        history_ts.append(t)
+        history_us.append(u)
+        expected = numpy.interp(t - delay, history_ts, history_us)
+        assert deadtime.change_input(t, u) == pytest.approx(expected)
+
+
+def test_discrete_tf_difference_equation():
+    # y[k] = (u[k] + 0.5*u[k-1] + 0.6*y[k-1] - 0.08*y[k-2])/2
+    Gd = blocksim.DiscreteTF('Gd', 'u', 'y', 1, [1, 0.5], [2, -0.6, 0.08])
+    us = numpy.cos(numpy.arange(20))
+    ys = [0, 0]
+    for k, u in enumerate(us):
+        ys.append((u + 0.5*(us[k-1] if k else 0) + 0.6*ys[-1] - 0.08*ys[-2])/2)
+        assert Gd.change_input(k + 0.5, u) == pytest.approx(ys[-1])
+
+
+def test_zoh_is_exact_for_step_input():
+    tau = 5
+    ts = numpy.arange(0, 30, 1.5)
+    G = blocksim.LTI('G', 'u', 'y', 1, [tau, 1])
+    diagram = blocksim.Diagram([G], {}, {'u': blocksim.step()})
+
+    expected = 1 - numpy.exp(-ts/tau)
+    assert diagram.simulate(ts)['y'] == pytest.approx(expected)
+    assert stepped(diagram, ts)['y'] == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("controller, numerator, denominator", [
+    (blocksim.PI('Gc', 'e', 'u', 2, 3), [6, 2], [3, 0]),
+    (blocksim.PID('Gc', 'e', 'u', 2, 3, 1, 0.2), [7.2, 6.4, 2], [0.6, 3, 0]),
+])
+def test_controllers_match_transfer_function(controller, numerator, denominator):
+    ts = numpy.linspace(0, 20, 401)
+    G = blocksim.LTI('G', 'u', 'yu', 1, [5, 6, 1])
+    general = blocksim.LTI('Gc', 'e', 'u', numerator, denominator)
+    for compiled in [True, False]:
+        outputs = [(diagram.simulate(ts) if compiled else stepped(diagram, ts))['y']
+                   for diagram in [blocksim.simple_control_diagram(Gc, G)
+                                   for Gc in [controller, general]]]
+        assert outputs[0] == pytest.approx(outputs[1])
+
+
+@pytest.mark.parametrize("delay", [0, 2], ids=['compiled', 'stepped'])
+def test_sweep_matches_simulate(delay):
+    ts = numpy.linspace(0, 30, 301)
+
+    def build(Kc, tau_i):
+        Gc = blocksim.PI('Gc', 'e', 'u', Kc, tau_i)
+        G = blocksim.LTI('G', 'u', 'yu', 1, [5, 6, 1], delay)
+        return blocksim.simple_control_diagram(Gc, G)
+
+    parameters = [(0.5, 5), (1, 5), (2, 10)]
+    results = blocksim.sweep(build, parameters, ts)
+
+    assert results['y'].shape == (3, len(ts))
+    for p, y in zip(parameters, results['y']):
+        assert y == pytest.approx(build(*p).simulate(ts)['y'])
+
+
+def test_float32_simulation():
+    ts = numpy.linspace(0, 50, 1001)
+    diagram = control_diagram()
+    expected = diagram.simulate(ts)
+    outputs = diagram.simulate(ts, dtype=numpy.float32)
+
+    assert outputs['y'].dtype == numpy.float32
+    assert outputs['y'] == pytest.approx(expected['y'], abs=1e-4)
+
+
+def test_custom_block_uses_euler():
+    class Integrator(blocksim.Block):
+        def reset(self):
+            self.state = 0
+
+        def change_input(self, t, u):
+            return self.state
+
+        def change_state(self, x):
+            self.state = x
+
+        def derivative(self, e):
+            return e
+
+    ts = numpy.arange(0, 5, 0.5)
+    diagram = blocksim.Diagram([Integrator('I', 'u', 'y')], {}, {'u': blocksim.step()})
+    assert diagram.simulate(ts)['y'] == pytest.approx(ts)
+
+
+@pytest.mark.parametrize("function", [blocksim.step(), blocksim.step(2, 1.5, -3), blocksim.zero],
+                         ids=['step', 'step_shifted', 'zero'])
+def test_vectorized_inputs(function):
+    ts = numpy.linspace(0, 3, 31)
+    assert function._vectorized(ts) == pytest.approx([function(t) for t in ts])
+
+
+def test_sum_without_sign():
+    G = blocksim.LTI('G', 'e', 'y', 1, [1, 1])
+    with pytest.raises(ValueError):
+        blocksim.Diagram([G], {'e': ('+ysp', 'y')}, {'ysp': blocksim.step()})
+
+
+@pytest.mark.parametrize("method, tolerance", [('zoh', 1e-12), ('rk4', 1e-4), ('euler', None)])
+def test_integration_methods(method, tolerance):
+    tau, dt = 5, 0.5
+    ts = numpy.arange(0, 30, dt)
+    G = blocksim.LTI('G', 'u', 'y', 1, [tau, 1])
+    diagram = blocksim.Diagram([G], {}, {'u': blocksim.step()})
+    y = diagram.simulate(ts, method=method)['y']
+
+    if tolerance is None:
+        assert y == pytest.approx(1 - (1 - dt/tau)**numpy.arange(len(ts)))
+    else:
+        assert y == pytest.approx(1 - numpy.exp(-ts/tau), abs=tolerance)
+
+
+def test_unknown_integration_method():
+    diagram = control_diagram()
+    with pytest.raises(ValueError):
+        diagram.simulate(numpy.linspace(0, 1, 11), method='midpoint')
+
+
+def test_reset_reuses_state():
+    ts = numpy.linspace(0, 20, 201)
+    diagram = control_diagram()
+    first = stepped(diagram, ts)
+    signals, X = diagram.signals, diagram._X
+    second = stepped(diagram, ts)
+
+    assert diagram.signals is signals and diagram._X is X
+    for signal, values in first.items():
+        assert second[signal] == pytest.approx(values)
+
+
+@pytest.mark.parametrize("dtype", [numpy.float64, numpy.float32])
+def test_extension_matches_kernel(dtype):
+    core = pytest.importorskip("tbcontrol._blocksim_core")
+    ts = numpy.linspace(0, 50, 1001)
+    diagram = control_diagram()
+    diagram.reset()
+    compiled = diagram.compile(ts[1])
+    input_values = diagram._input_values(ts).astype(dtype)
+
+    results = []
+    for kernel in [core.simulate, blocksim._simulate]:
+        xs = numpy.zeros(compiled.states.sum(), dtype=dtype)
+        ys = numpy.zeros((len(compiled.signals), len(ts)), dtype=dtype)
+        kernel(compiled.As.astype(dtype), compiled.Bs.astype(dtype),
+               compiled.Cs.astype(dtype), compiled.Ds.astype(dtype),
+               compiled.states, compiled.offsets, compiled.block_inputs, compiled.block_outputs,
+               compiled.S.astype(dtype), compiled.sum_outputs, compiled.input_signals,
+               input_values, xs, ys, len(ts))
+        results.append(ys)
+    # numba compiles the kernel with fastmath, so float32 rounding differs slightly
+    assert results[0] == pytest.approx(results[1], abs=1e-4 if dtype is numpy.float32 else 1e-12)
+
+
+def test_subclass_overrides_are_used():
+    class LimitedPI(blocksim.PI):
+        def change_input(self, t, u):
+            return numpy.clip(super().change_input(t, u), -0.2, 0.2)
+
+    class ClampedPI(blocksim.PI):
+        def advance(self, u):
+            super().advance(u)
+            self.integral = min(self.integral, 0.1)
+
+    class ClampedLTI(blocksim.LTI):
+        def advance(self, u):
+            super().advance(u)
+            self.x[:] = numpy.minimum(self.x, 0.05)
+
+    ts = numpy.linspace(0, 20, 201)
+    G = blocksim.LTI('G', 'u', 'yu', 1, [5, 6, 1])
+    Gc = LimitedPI('Gc', 'e', 'u', 5, 2)
+    diagram = blocksim.simple_control_diagram(Gc, G)
+    outputs = diagram.simulate(ts)
+    assert max(abs(outputs['u'])) == pytest.approx(0.2)
+    assert outputs['u'] == pytest.approx(stepped(diagram, ts)['u'])
+
+    Gc = ClampedPI('Gc', 'e', 'u', 5, 2)
+    diagram = blocksim.simple_control_diagram(Gc, G)
+    diagram.simulate(ts)
+    assert Gc.integral == pytest.approx(0.1)
+
+    G = ClampedLTI('G', 'u', 'y', 1, [5, 6, 1])
+    diagram = blocksim.Diagram([G], {}, {'u': blocksim.step()})
+    diagram.simulate(ts)
+    assert max(G.x) == pytest.approx(0.05)
+
+
+def test_recorded_states_are_copies():
+    G = blocksim.LTI('G', 'u', 'y', 1, [5, 6, 1])
+    diagram = blocksim.Diagram([G], {}, {'u': blocksim.step()})
+    diagram.reset()
+    states = []
+    for t in numpy.arange(0, 5, 0.5):
+        diagram.step(t, 0.5)
+        states.append(G.state)
+
+    assert not numpy.allclose(states[0], states[-1])
+    assert states[-1] == pytest.approx(G.x)
+
+
+@pytest.mark.parametrize("dtype", [numpy.float16, numpy.int64])
+def test_unsupported_dtype(dtype):
+    ts = numpy.linspace(0, 1, 11)
+    with pytest.raises(ValueError):
+        control_diagram().simulate(ts, dtype=dtype)
+    with pytest.raises(ValueError):
+        blocksim.sweep(lambda Kc: control_diagram(), [1, 2], ts, dtype=dtype)
+
+
+def test_import_with_jit_disabled():
+    environment = dict(os.environ, NUMBA_DISABLE_JIT='1')
+    subprocess.run([sys.executable, '-c', 'import tbcontrol.blocksim'],
+                   env=environment, check=True)
+
+
+@pytest.mark.parametrize("block", [blocksim.LTI('G', 'u', 'y', 1, [5, 6, 1]),
+                                   blocksim.PID('G', 'u', 'y', 1, 2, 3)],
+                         ids=['LTI', 'PID'])
+def test_state_can_be_set(block):
+    block.state = [0.5, 0.25]
+    assert block.state == pytest.approx([0.5, 0.25])
+    assert block.x == pytest.approx([0.5, 0.25])
+
+
+def test_subclass_setting_state():
+    class Recorded(blocksim.LTI):
+        # The way blocks used to store their state
+        def change_state(self, x):
+            self.x = self.state = numpy.array(x, dtype=float)
+
+    G = Recorded('G', 'u', 'y', 1, [5, 6, 1])
+    G.change_state([0.5, 0.25])
+    assert G.state == pytest.approx([0.5, 0.25])
+    assert G.change_input(0, 0) == pytest.approx(G.c @ [0.5, 0.25])
+
+
+def test_compiled_kernel_uses_diagram_state():
+    ts = numpy.linspace(0, 50, 1001)
+    diagram = control_diagram()
+    G = next(block for block in diagram.blocks if block.name == 'G')
+    Gc = next(block for block in diagram.blocks if block.name == 'Gc')
+    # The PI controller keeps its own state, so only the others are laid out
+    assert len(diagram._X) == sum(block.A.shape[0] for block in diagram.blocks
+                                  if block is not Gc)
+
+    diagram.simulate(ts)
+    assert numpy.shares_memory(G.x, diagram._X)
+    compiled_state = G.state, Gc.state
+    stepped(diagram, ts)
+    assert compiled_state[0] == pytest.approx(G.state)
+    assert compiled_state[1] == pytest.approx(Gc.state)